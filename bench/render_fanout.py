@@ -0,0 +1,52 @@
+"""Benchmark alert rendering when one transaction fans out to many chats.
+
+Compares AlertRenderer.render_transaction, which shares rendered messages
+across recipients, with rendering every alert from scratch.
+
+Usage: python bench/render_fanout.py [recipients ...]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bot import AlertRenderer, RENDER_CACHE_SIZE
+
+TIMEZONES = ['Africa/Lagos', 'Europe/Berlin', 'Asia/Tokyo']
+TX = {
+    'hash': '0x' + 'ab' * 32,
+    'from': '0x' + 'cd' * 20,
+    'to': '0x' + 'ef' * 20,
+    'value': 123 * 10 ** 18,
+    'timestamp': 1700000000,
+    'blockNumber': 123,
+}
+
+def bench_cached(recipients: int) -> float:
+    renderer = AlertRenderer(RENDER_CACHE_SIZE)
+    started = time.perf_counter()
+    for i in range(recipients):
+        renderer.render_transaction(TX, True, TIMEZONES[i % len(TIMEZONES)])
+    return time.perf_counter() - started
+
+def bench_uncached(recipients: int) -> float:
+    renderer = AlertRenderer(RENDER_CACHE_SIZE)
+    started = time.perf_counter()
+    for i in range(recipients):
+        renderer._render_transaction(TX, True, TIMEZONES[i % len(TIMEZONES)])
+        renderer.timestamps.clear()
+    return time.perf_counter() - started
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    for recipients in counts:
+        cached = bench_cached(recipients)
+        uncached = bench_uncached(recipients)
+        print(f"{recipients:>7} recipients: "
+              f"shared {cached * 1000:8.1f} ms ({cached * 1e6 / recipients:5.2f} us each), "
+              f"per-recipient {uncached * 1000:8.1f} ms ({uncached * 1e6 / recipients:5.2f} us each), "
+              f"{uncached / cached:5.1f}x")
+
+if __name__ == '__main__':
+    main()
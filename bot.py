@@ -1,13 +1,22 @@
 import os
+import csv
+import cProfile
 import json
 import time
 import logging
 import requests
 import hashlib
+import html
+from contextlib import contextmanager
+from bisect import bisect_right
 from datetime import datetime
+from decimal import Decimal, InvalidOperation
 from typing import Optional, Dict, List
 import sqlite3
-from threading import Thread
+import queue
+import tempfile
+from collections import OrderedDict
+from threading import Thread, Lock, Event, Condition, local
 import pytz
 
 # Configure logging
@@ -25,8 +34,242 @@ CONFIRMATIONS = int(os.getenv('CONFIRMATIONS', '3'))
 POLL_INTERVAL_SEC = int(os.getenv('POLL_INTERVAL_SEC', '20'))
 TIMEZONE = pytz.timezone(os.getenv('TZ', 'Africa/Lagos'))
 DB_PATH = os.getenv('DB_PATH', 'iotex_bot.db')
+BALANCE_CACHE_TTL_SEC = int(os.getenv('BALANCE_CACHE_TTL_SEC', '300'))
+BALANCE_REFRESH_SEC = int(os.getenv('BALANCE_REFRESH_SEC', '120'))
+RPC_BATCH_SIZE = int(os.getenv('RPC_BATCH_SIZE', '50'))
+PORTFOLIO_MAX_ADDRESSES = 20
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '10'))
+HISTORY_MAX_PAGE_SIZE = 50
+# Telegram rejects bot uploads above 50 MB
+EXPORT_MAX_BYTES = 50 * 1024 * 1024
+EXPORT_QUEUE_SIZE = int(os.getenv('EXPORT_QUEUE_SIZE', '20'))
+SLOW_CYCLE_SEC = float(os.getenv('SLOW_CYCLE_SEC', '5'))
+PROFILE_CYCLES = int(os.getenv('PROFILE_CYCLES', '0'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_MAX_CYCLES = 20
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH', DB_PATH + '.snapshot')
+SNAPSHOT_INTERVAL_SEC = int(os.getenv('SNAPSHOT_INTERVAL_SEC', '300'))
+RECENT_BLOCKS = 64
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '10000'))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+OUTBOX_RETENTION_SEC = int(os.getenv('OUTBOX_RETENTION_SEC', str(7 * 24 * 3600)))
+TELEGRAM_RATE_PER_SEC = float(os.getenv('TELEGRAM_RATE_PER_SEC', '25'))
+COMMAND_QUEUE_SIZE = int(os.getenv('COMMAND_QUEUE_SIZE', '500'))
+# Pending outbox rows at which delivery switches to digests, and at which
+# the scanner stops taking on new blocks until delivery catches up
+DIGEST_BACKLOG = int(os.getenv('DIGEST_BACKLOG', '1000'))
+PAUSE_BACKLOG = int(os.getenv('PAUSE_BACKLOG', '5000'))
+MAX_SCAN_BLOCKS = 50
+# Total IOTX supply; no alert threshold can usefully exceed it
+IOTX_TOTAL_SUPPLY = 10_000_000_000
+
+# Send priority classes, lowest value goes first
+PRIORITY_COMMAND = 0
+PRIORITY_ALERT = 1
+PRIORITY_DIGEST = 2
+
+ADMIN_CHAT_IDS = {int(x) for x in os.getenv('ADMIN_CHAT_IDS', '').split(',') if x.strip()}
 
 TELEGRAM_API = f"https://api.telegram.org/bot{BOT_TOKEN}"
+STARTED_AT = time.perf_counter()
+
+class StageTracer:
+    """Lightweight per-cycle stage timing with optional cProfile capture"""
+    
+    def __init__(self, profile_cycles: int = 0):
+        self.local = local()
+        self.lock = Lock()
+        self.profile_cycles = profile_cycles
+    
+    @contextmanager
+    def span(self, stage: str):
+        """Time a stage; a no-op outside of a traced cycle"""
+        stages = getattr(self.local, 'stages', None)
+        if stages is None:
+            yield
+            return
+        
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = stages.setdefault(stage, [0, 0.0])
+            entry[0] += 1
+            entry[1] += time.perf_counter() - start
+    
+    @contextmanager
+    def cycle(self, name: str, profile: bool = False):
+        """Trace one cycle and log a summary line if it was slow"""
+        self.local.stages = {}
+        profiler = self._start_profiler() if profile else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            stages = self.local.stages
+            self.local.stages = None
+            
+            if profiler:
+                self._dump_profile(profiler, name)
+            
+            if elapsed >= SLOW_CYCLE_SEC:
+                summary = {
+                    'cycle': name,
+                    'total_ms': round(elapsed * 1000, 1),
+                    'stages': {
+                        stage: {'count': count, 'ms': round(total * 1000, 1)}
+                        for stage, (count, total) in stages.items()
+                    }
+                }
+                logger.warning(f"Slow cycle: {json.dumps(summary, separators=(',', ':'))}")
+    
+    def request_profile(self, cycles: int):
+        """Capture a cProfile for each of the next N profiled cycles"""
+        with self.lock:
+            self.profile_cycles = cycles
+    
+    def _start_profiler(self) -> Optional[cProfile.Profile]:
+        with self.lock:
+            if self.profile_cycles <= 0:
+                return None
+            self.profile_cycles -= 1
+        
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    
+    def _dump_profile(self, profiler: cProfile.Profile, name: str):
+        profiler.disable()
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"{name}-{int(time.time() * 1000)}.prof")
+            profiler.dump_stats(path)
+            logger.info(f"Wrote profile to {path}")
+        except Exception as e:
+            logger.error(f"Error writing profile: {e}")
+
+tracer = StageTracer(PROFILE_CYCLES)
+
+class SendGate:
+    """Rate-limits Telegram sends across threads, serving higher priority
+    classes first"""
+    
+    def __init__(self, rate_per_sec: float):
+        self.interval = 1.0 / rate_per_sec
+        self.cond = Condition()
+        self.waiting = [0, 0, 0]
+        self.next_slot = 0.0
+    
+    def acquire(self, priority: int):
+        with self.cond:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    if any(self.waiting[:priority]):
+                        self.cond.wait(0.05)
+                    elif now < self.next_slot:
+                        self.cond.wait(self.next_slot - now)
+                    else:
+                        self.next_slot = now + self.interval
+                        return
+            finally:
+                self.waiting[priority] -= 1
+                self.cond.notify_all()
+
+# Schema migrations, applied in order and recorded in PRAGMA user_version.
+# Released entries must never change; append a new one instead.
+MIGRATIONS = [
+    # 1: users and per-user cursors
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            chat_id INTEGER PRIMARY KEY,
+            io_address TEXT,
+            eth_address TEXT,
+            alert_rewards INTEGER DEFAULT 1,
+            alert_tx_in INTEGER DEFAULT 1,
+            alert_tx_out INTEGER DEFAULT 1,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS last_blocks (
+            chat_id INTEGER PRIMARY KEY,
+            block_number INTEGER
+        )
+        ''',
+    ],
+    # 2: append-only history of matched transactions
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS tx_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            address TEXT NOT NULL,
+            block_number INTEGER NOT NULL,
+            tx_hash TEXT NOT NULL,
+            from_address TEXT,
+            to_address TEXT,
+            value TEXT,
+            gas_price TEXT,
+            gas_used INTEGER,
+            timestamp INTEGER,
+            UNIQUE (address, tx_hash)
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_tx_history_address_block
+        ON tx_history (address, block_number, id)
+        ''',
+    ],
+    # 3: transactional outbox of alerts waiting for delivery
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            chat_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON outbox (status, next_attempt_at, id)
+        ''',
+    ],
+    # 4: per-user alert rules (JSON)
+    [
+        'ALTER TABLE users ADD COLUMN rules TEXT',
+    ],
+    # 5: revision counter bumped on every user change, used to tell whether
+    # a startup snapshot is still current; cursors are always read from
+    # last_blocks, so scan commits do not touch it
+    [
+        'CREATE TABLE IF NOT EXISTS bot_state (key TEXT PRIMARY KEY, value INTEGER)',
+        "INSERT OR IGNORE INTO bot_state (key, value) VALUES ('state_rev', 0)",
+    ] + [
+        f'''
+        CREATE TRIGGER IF NOT EXISTS users_{event.lower()}_rev AFTER {event} ON users
+        BEGIN
+            UPDATE bot_state SET value = value + 1 WHERE key = 'state_rev';
+        END
+        '''
+        for event in ('INSERT', 'UPDATE', 'DELETE')
+    ],
+    # 6: the outbox idempotency keys replaced processed_txs deduplication;
+    # drop the table and the chat ids and tx hashes left in it
+    [
+        'DROP TABLE IF EXISTS processed_txs',
+    ],
+]
 
 class Database:
     def __init__(self, db_path: str):
@@ -37,42 +280,31 @@ class Database:
         conn = sqlite3.connect(self.db_path)
         c = conn.cursor()
         
-        # Users table
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                chat_id INTEGER PRIMARY KEY,
-                io_address TEXT,
-                eth_address TEXT,
-                alert_rewards INTEGER DEFAULT 1,
-                alert_tx_in INTEGER DEFAULT 1,
-                alert_tx_out INTEGER DEFAULT 1,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        version = c.execute('PRAGMA user_version').fetchone()[0]
+        if version >= len(MIGRATIONS):
+            conn.close()
+            return
         
-        # Processed transactions table (for deduplication)
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS processed_txs (
-                chat_id INTEGER,
-                tx_hash TEXT,
-                processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (chat_id, tx_hash)
-            )
-        ''')
+        # Detection and delivery write from different threads
+        c.execute('PRAGMA journal_mode=WAL')
         
-        # Last seen blocks
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS last_blocks (
-                chat_id INTEGER PRIMARY KEY,
-                block_number INTEGER
-            )
-        ''')
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            c.execute('BEGIN')
+            for statement in statements:
+                try:
+                    c.execute(statement)
+                except sqlite3.OperationalError as e:
+                    # Databases created before versioning may already have the column
+                    if 'duplicate column' not in str(e):
+                        raise
+            c.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+            logger.info(f"Applied schema migration {number}")
         
-        conn.commit()
         conn.close()
     
     def get_connection(self):
-        return sqlite3.connect(self.db_path)
+        return sqlite3.connect(self.db_path, timeout=30)
     
     def save_user(self, chat_id: int, io_address: str, eth_address: str):
         conn = self.get_connection()
@@ -84,46 +316,46 @@ class Database:
         conn.commit()
         conn.close()
     
+    USER_COLUMNS = 'chat_id, io_address, eth_address, alert_rewards, alert_tx_in, alert_tx_out, rules'
+    
     def get_user(self, chat_id: int) -> Optional[Dict]:
         conn = self.get_connection()
         c = conn.cursor()
-        c.execute('SELECT * FROM users WHERE chat_id = ?', (chat_id,))
+        c.execute(f'SELECT {self.USER_COLUMNS} FROM users WHERE chat_id = ?', (chat_id,))
         row = c.fetchone()
         conn.close()
         
         if row:
-            return {
-                'chat_id': row[0],
-                'io_address': row[1],
-                'eth_address': row[2],
-                'alert_rewards': row[3],
-                'alert_tx_in': row[4],
-                'alert_tx_out': row[5]
-            }
+            return self._user_row(row)
         return None
     
     def get_all_users(self) -> List[Dict]:
         conn = self.get_connection()
         c = conn.cursor()
-        c.execute('SELECT * FROM users WHERE io_address IS NOT NULL')
+        c.execute(f'SELECT {self.USER_COLUMNS} FROM users WHERE io_address IS NOT NULL')
         rows = c.fetchall()
         conn.close()
         
-        return [{
+        return [self._user_row(row) for row in rows]
+    
+    @staticmethod
+    def _user_row(row) -> Dict:
+        return {
             'chat_id': row[0],
             'io_address': row[1],
             'eth_address': row[2],
             'alert_rewards': row[3],
             'alert_tx_in': row[4],
-            'alert_tx_out': row[5]
-        } for row in rows]
+            'alert_tx_out': row[5],
+            'rules': json.loads(row[6]) if row[6] else {}
+        }
     
     def delete_user(self, chat_id: int):
         conn = self.get_connection()
         c = conn.cursor()
         c.execute('DELETE FROM users WHERE chat_id = ?', (chat_id,))
-        c.execute('DELETE FROM processed_txs WHERE chat_id = ?', (chat_id,))
         c.execute('DELETE FROM last_blocks WHERE chat_id = ?', (chat_id,))
+        c.execute("DELETE FROM outbox WHERE chat_id = ? AND status = 'pending'", (chat_id,))
         conn.commit()
         conn.close()
     
@@ -138,30 +370,53 @@ class Database:
         conn.commit()
         conn.close()
     
-    def is_tx_processed(self, chat_id: int, tx_hash: str) -> bool:
+    def update_rules(self, chat_id: int, rules: Dict):
         conn = self.get_connection()
         c = conn.cursor()
-        c.execute('SELECT 1 FROM processed_txs WHERE chat_id = ? AND tx_hash = ?',
-                  (chat_id, tx_hash))
-        exists = c.fetchone() is not None
+        c.execute('UPDATE users SET rules = ? WHERE chat_id = ?',
+                  (json.dumps(rules), chat_id))
+        conn.commit()
         conn.close()
-        return exists
     
-    def mark_tx_processed(self, chat_id: int, tx_hash: str):
+    def get_state_rev(self) -> int:
         conn = self.get_connection()
         c = conn.cursor()
-        c.execute('INSERT OR IGNORE INTO processed_txs (chat_id, tx_hash) VALUES (?, ?)',
-                  (chat_id, tx_hash))
-        conn.commit()
+        c.execute("SELECT value FROM bot_state WHERE key = 'state_rev'")
+        row = c.fetchone()
+        conn.close()
+        return row[0] if row else 0
+    
+    def read_state(self) -> tuple:
+        """Return (state_rev, users) from one consistent read"""
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('BEGIN')
+            c.execute("SELECT value FROM bot_state WHERE key = 'state_rev'")
+            state_rev = c.fetchone()[0]
+            c.execute(f'SELECT {self.USER_COLUMNS} FROM users WHERE io_address IS NOT NULL')
+            users = [self._user_row(row) for row in c.fetchall()]
+            conn.commit()
+        finally:
+            conn.close()
+        return state_rev, users
+    
+    def get_last_blocks(self) -> Dict[int, int]:
+        conn = self.get_connection()
+        c = conn.cursor()
+        c.execute('SELECT chat_id, block_number FROM last_blocks')
+        rows = c.fetchall()
         conn.close()
+        return {row[0]: row[1] for row in rows}
     
-    def get_last_block(self, chat_id: int) -> Optional[int]:
+    def init_last_blocks(self, chat_ids: List[int], block_number: int):
+        # Keeps a cursor written concurrently by /setaddress
         conn = self.get_connection()
         c = conn.cursor()
-        c.execute('SELECT block_number FROM last_blocks WHERE chat_id = ?', (chat_id,))
-        row = c.fetchone()
+        c.executemany('INSERT OR IGNORE INTO last_blocks (chat_id, block_number) VALUES (?, ?)',
+                      [(chat_id, block_number) for chat_id in chat_ids])
+        conn.commit()
         conn.close()
-        return row[0] if row else None
     
     def update_last_block(self, chat_id: int, block_number: int):
         conn = self.get_connection()
@@ -170,6 +425,158 @@ class Database:
                   (chat_id, block_number))
         conn.commit()
         conn.close()
+    
+    @staticmethod
+    def _insert_history(c, entries: List[tuple]):
+        # Values are stored as text because RAU amounts overflow SQLite integers
+        c.executemany('''
+            INSERT OR IGNORE INTO tx_history
+                (address, block_number, tx_hash, from_address, to_address,
+                 value, gas_price, gas_used, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(address, tx['blockNumber'], tx['hash'], tx.get('from'), tx.get('to'),
+               str(tx.get('value', 0)), str(tx.get('gasPrice', 0)),
+               tx.get('gasUsed', 0), tx.get('timestamp', 0))
+              for address, tx in entries])
+    
+    def commit_scan(self, alerts: List[Dict], history: List[tuple],
+                    chat_ids: List[int], block_number: int):
+        """Write a scan's alerts and history and advance cursors atomically.
+
+        Alerts are keyed by idempotency key, so a range that is scanned
+        again after a crash cannot enqueue the same alert twice.
+        """
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.executemany('''
+                INSERT OR IGNORE INTO outbox (idempotency_key, chat_id, kind, payload)
+                VALUES (?, ?, ?, ?)
+            ''', [(a['key'], a['chat_id'], a['kind'], json.dumps(a['payload'])) for a in alerts])
+            self._insert_history(c, history)
+            # Only advance existing cursors: a concurrent /setaddress may have
+            # moved one ahead, and /unsubscribe may have removed one
+            c.executemany('UPDATE last_blocks SET block_number = MAX(block_number, ?) WHERE chat_id = ?',
+                          [(block_number, chat_id) for chat_id in chat_ids])
+            conn.commit()
+        finally:
+            conn.close()
+    
+    def get_pending_outbox(self, limit: int) -> List[Dict]:
+        conn = self.get_connection()
+        c = conn.cursor()
+        c.execute('''
+            SELECT id, chat_id, kind, payload, attempts FROM outbox
+            WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY id
+            LIMIT ?
+        ''', (time.time(), limit))
+        rows = c.fetchall()
+        conn.close()
+        return [{
+            'id': row[0],
+            'chat_id': row[1],
+            'kind': row[2],
+            'payload': json.loads(row[3]),
+            'attempts': row[4]
+        } for row in rows]
+    
+    def count_pending_outbox(self) -> int:
+        conn = self.get_connection()
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'")
+        count = c.fetchone()[0]
+        conn.close()
+        return count
+    
+    def mark_outbox_sent(self, outbox_ids: List[int]):
+        conn = self.get_connection()
+        c = conn.cursor()
+        c.executemany('''
+            UPDATE outbox SET status = 'sent', sent_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', [(outbox_id,) for outbox_id in outbox_ids])
+        conn.commit()
+        conn.close()
+    
+    def mark_outbox_failed(self, outbox_id: int, attempts: int, retry_at: Optional[float]):
+        """Schedule a retry, or give up when retry_at is None"""
+        conn = self.get_connection()
+        c = conn.cursor()
+        c.execute('''
+            UPDATE outbox SET attempts = ?, next_attempt_at = ?, status = ?
+            WHERE id = ?
+        ''', (attempts, retry_at or 0, 'pending' if retry_at else 'failed', outbox_id))
+        conn.commit()
+        conn.close()
+    
+    def prune_outbox(self, max_age_sec: int):
+        conn = self.get_connection()
+        c = conn.cursor()
+        c.execute('''
+            DELETE FROM outbox
+            WHERE status != 'pending' AND created_at < datetime('now', ?)
+        ''', (f'-{max_age_sec} seconds',))
+        conn.commit()
+        conn.close()
+    
+    def get_history(self, address: str, limit: int,
+                    before: Optional[tuple] = None) -> List[Dict]:
+        """Return one page of history, newest first.
+
+        ``before`` is the (block_number, id) of the last row of the previous
+        page, so each page is a single index range scan regardless of depth.
+        """
+        conn = self.get_connection()
+        c = conn.cursor()
+        if before:
+            c.execute('''
+                SELECT * FROM tx_history
+                WHERE address = ? AND (block_number, id) < (?, ?)
+                ORDER BY block_number DESC, id DESC
+                LIMIT ?
+            ''', (address, before[0], before[1], limit))
+        else:
+            c.execute('''
+                SELECT * FROM tx_history
+                WHERE address = ?
+                ORDER BY block_number DESC, id DESC
+                LIMIT ?
+            ''', (address, limit))
+        rows = c.fetchall()
+        conn.close()
+        return [self._history_row(row) for row in rows]
+    
+    def iter_history(self, address: str):
+        """Yield every history row for an address, oldest first, without
+        loading the whole result set into memory"""
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('''
+                SELECT * FROM tx_history
+                WHERE address = ?
+                ORDER BY block_number, id
+            ''', (address,))
+            for row in c:
+                yield self._history_row(row)
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def _history_row(row) -> Dict:
+        return {
+            'id': row[0],
+            'address': row[1],
+            'blockNumber': row[2],
+            'hash': row[3],
+            'from': row[4],
+            'to': row[5],
+            'value': int(row[6] or 0),
+            'gasPrice': int(row[7] or 0),
+            'gasUsed': row[8],
+            'timestamp': row[9]
+        }
 
 class AddressConverter:
     @staticmethod
@@ -247,7 +654,8 @@ class IoTeXAPI:
                 "params": [],
                 "id": 1
             }
-            response = self.session.post(self.rpc_url, json=payload, timeout=15)
+            with tracer.span('rpc'):
+                response = self.session.post(self.rpc_url, json=payload, timeout=15)
             if response.status_code == 200:
                 result = response.json().get('result')
                 if result:
@@ -284,9 +692,11 @@ class IoTeXAPI:
                 "params": [block_hex, full_tx],
                 "id": 1
             }
-            response = self.session.post(self.rpc_url, json=payload, timeout=15)
+            with tracer.span('rpc'):
+                response = self.session.post(self.rpc_url, json=payload, timeout=15)
             if response.status_code == 200:
-                return response.json().get('result')
+                with tracer.span('decode'):
+                    return response.json().get('result')
         except Exception as e:
             logger.error(f"Error getting block {block_num}: {e}")
         return None
@@ -308,54 +718,78 @@ class IoTeXAPI:
         except Exception as e:
             logger.error(f"Error getting balance: {e}")
         return None
-    
-    def get_transactions_from_blocks(self, address: str, start_block: int, end_block: int) -> List[Dict]:
-        """Get transactions for an address by scanning blocks"""
+
+    def get_balances(self, addresses: List[str]) -> tuple:
+        """Get balances for many addresses using JSON-RPC batches.
+
+        Returns (block_height, {address: balance_in_rau}). The block height is
+        read in the first batch so every balance can be keyed to it.
+        """
+        balances = {}
+        block_height = None
+
+        for i in range(0, len(addresses), RPC_BATCH_SIZE):
+            chunk = addresses[i:i + RPC_BATCH_SIZE]
+            payload = [{
+                "jsonrpc": "2.0",
+                "method": "eth_getBalance",
+                "params": [address, 'latest'],
+                "id": n + 1
+            } for n, address in enumerate(chunk)]
+            if block_height is None:
+                payload.append({
+                    "jsonrpc": "2.0",
+                    "method": "eth_blockNumber",
+                    "params": [],
+                    "id": 0
+                })
+
+            try:
+                response = self.session.post(self.rpc_url, json=payload, timeout=30)
+                if response.status_code != 200:
+                    logger.error(f"Balance batch failed with status {response.status_code}")
+                    continue
+                results = response.json()
+                if not isinstance(results, list):
+                    results = [results]
+
+                for item in results:
+                    result = item.get('result')
+                    if not result:
+                        continue
+                    if item.get('id') == 0:
+                        block_height = int(result, 16)
+                    else:
+                        balances[chunk[item['id'] - 1]] = int(result, 16)
+            except Exception as e:
+                logger.error(f"Error getting balance batch: {e}")
+
+        return block_height, balances
+
+    def get_transactions_from_blocks(self, addresses, start_block: int, end_block: int,
+                                     block_hashes: Optional[Dict] = None) -> List[Dict]:
+        """Get transactions touching any of the given addresses by scanning blocks once.
+
+        If ``block_hashes`` is given, it is filled with
+        {block_number: (hash, parent_hash)} for every block fetched.
+        """
         transactions = []
-        address = address.lower()
+        if isinstance(addresses, str):
+            addresses = {addresses.lower()}
         
         try:
             # Scan blocks in batches
             for block_num in range(start_block, end_block + 1):
                 try:
                     block = self.get_block_by_number(block_num, True)
+                    if block and block_hashes is not None:
+                        block_hashes[block_num] = (block.get('hash'), block.get('parentHash'))
                     if not block or not block.get('transactions'):
                         continue
                     
                     # Check each transaction in the block
-                    for tx in block['transactions']:
-                        if not isinstance(tx, dict):
-                            continue
-                        
-                        tx_from = tx.get('from', '').lower()
-                        tx_to = tx.get('to', '').lower()
-                        
-                        # Check if transaction involves our address
-                        if tx_from == address or tx_to == address:
-                            # Convert hex values to decimal
-                            value_hex = tx.get('value', '0x0')
-                            value = int(value_hex, 16) if value_hex else 0
-                            
-                            gas_price_hex = tx.get('gasPrice', '0x0')
-                            gas_price = int(gas_price_hex, 16) if gas_price_hex else 0
-                            
-                            gas_hex = tx.get('gas', '0x0')
-                            gas_used = int(gas_hex, 16) if gas_hex else 0
-                            
-                            timestamp = int(block.get('timestamp', '0x0'), 16)
-                            
-                            transactions.append({
-                                'hash': tx.get('hash'),
-                                'from': tx_from,
-                                'to': tx_to,
-                                'value': value,
-                                'gasPrice': gas_price,
-                                'gasUsed': gas_used,
-                                'timestamp': timestamp,
-                                'blockNumber': block_num,
-                                'blockHash': tx.get('blockHash'),
-                                'status': 1  # Assume success if in block
-                            })
+                    with tracer.span('match'):
+                        self._match_block(block, block_num, addresses, transactions)
                 
                 except Exception as e:
                     logger.error(f"Error processing block {block_num}: {e}")
@@ -365,23 +799,396 @@ class IoTeXAPI:
             logger.error(f"Error scanning blocks {start_block}-{end_block}: {e}")
         
         return transactions
+    
+    def _match_block(self, block: Dict, block_num: int, addresses, transactions: List[Dict]):
+        for tx in block['transactions']:
+            if not isinstance(tx, dict):
+                continue
+            
+            tx_from = (tx.get('from') or '').lower()
+            tx_to = (tx.get('to') or '').lower()
+            
+            # Check if transaction involves a watched address
+            if tx_from in addresses or tx_to in addresses:
+                # Convert hex values to decimal
+                value_hex = tx.get('value', '0x0')
+                value = int(value_hex, 16) if value_hex else 0
+            
+                gas_price_hex = tx.get('gasPrice', '0x0')
+                gas_price = int(gas_price_hex, 16) if gas_price_hex else 0
+            
+                gas_hex = tx.get('gas', '0x0')
+                gas_used = int(gas_hex, 16) if gas_hex else 0
+            
+                timestamp = int(block.get('timestamp', '0x0'), 16)
+            
+                transactions.append({
+                    'hash': tx.get('hash'),
+                    'from': tx_from,
+                    'to': tx_to,
+                    'value': value,
+                    'gasPrice': gas_price,
+                    'gasUsed': gas_used,
+                    'timestamp': timestamp,
+                    'blockNumber': block_num,
+                    'blockHash': tx.get('blockHash'),
+                    'status': 1  # Assume success if in block
+                })
+
+class BalanceCache:
+    """In-memory balance cache keyed by (address, block height)"""
+
+    def __init__(self, ttl_sec: int):
+        self.ttl_sec = ttl_sec
+        self.entries: Dict[str, tuple] = {}  # address -> (block, balance, fetched_at)
+        self.lock = Lock()
+        self.fetch_lock = Lock()
+
+    def get(self, address: str) -> Optional[tuple]:
+        """Return (balance, block) if a fresh entry exists"""
+        with self.lock:
+            entry = self.entries.get(address)
+        if not entry:
+            return None
+        block, balance, fetched_at = entry
+        if time.time() - fetched_at > self.ttl_sec:
+            return None
+        return balance, block
+
+    def put(self, address: str, block: int, balance: int):
+        """Store a balance unless a newer block is already cached"""
+        with self.lock:
+            entry = self.entries.get(address)
+            if entry and block is not None and entry[0] is not None and entry[0] > block:
+                return
+            self.entries[address] = (block, balance, time.time())
+
+    def invalidate(self, address: str, block: int):
+        """Drop the cached balance if it was read before the given block"""
+        with self.lock:
+            entry = self.entries.get(address)
+            if entry and (entry[0] is None or entry[0] < block):
+                del self.entries[address]
+
+    def prune(self):
+        """Evict expired entries, e.g. one-off /portfolio lookups"""
+        cutoff = time.time() - self.ttl_sec
+        with self.lock:
+            expired = [address for address, entry in self.entries.items() if entry[2] < cutoff]
+            for address in expired:
+                del self.entries[address]
+
+class AlertRule:
+    """A user's alert preferences compiled into plain values and sets"""
+    __slots__ = ('chat_id', 'address', 'tx_in', 'tx_out', 'min_value', 'allow', 'deny', 'quiet', 'tz')
+    
+    def __init__(self, entry: list, address: str):
+        chat_id, tx_in, tx_out, rules = entry
+        rules = rules or {}
+        self.chat_id = chat_id
+        self.address = address
+        self.tx_in = bool(tx_in)
+        self.tx_out = bool(tx_out)
+        # Zero-value txs never alert, so the floor is 1 RAU
+        self.min_value = max(int(rules.get('min', 0)), 1)
+        self.allow = frozenset(rules['allow']) if rules.get('allow') else None
+        self.deny = frozenset(rules.get('deny') or ())
+        self.quiet = tuple(rules['quiet']) if rules.get('quiet') else None
+        self.tz = rules.get('tz') or TIMEZONE.zone
+    
+    def is_quiet(self, clock: 'LocalClock') -> bool:
+        if not self.quiet:
+            return False
+        minute_of_day = clock[self.tz]
+        start, end = self.quiet
+        if start <= end:
+            return start <= minute_of_day < end
+        return minute_of_day >= start or minute_of_day < end
+
+class LocalClock(dict):
+    """Minute of day per timezone name, computed once per scan"""
+    
+    def __init__(self, now: datetime):
+        super().__init__()
+        self.now = now
+    
+    def __missing__(self, tz_name: str) -> int:
+        local = self.now.astimezone(pytz.timezone(tz_name))
+        minute_of_day = local.hour * 60 + local.minute
+        self[tz_name] = minute_of_day
+        return minute_of_day
+
+class AddressRules:
+    """Rules for one watched address and direction, indexed for lookup"""
+    
+    def __init__(self, rules: List[AlertRule]):
+        # Sorted by threshold so bisect yields every rule a value satisfies
+        self.rules = sorted(rules, key=lambda r: r.min_value)
+        self.thresholds = [r.min_value for r in self.rules]
+        self.allowed_by: Dict[str, set] = {}
+        self.denied_by: Dict[str, set] = {}
+        for rule in self.rules:
+            for counterparty in rule.allow or ():
+                self.allowed_by.setdefault(counterparty, set()).add(rule.chat_id)
+            for counterparty in rule.deny:
+                self.denied_by.setdefault(counterparty, set()).add(rule.chat_id)
+    
+    def match(self, value: int, counterparty: str, clock: LocalClock) -> List[AlertRule]:
+        candidates = self.rules[:bisect_right(self.thresholds, value)]
+        if not candidates:
+            return []
+        allowed = self.allowed_by.get(counterparty, ())
+        denied = self.denied_by.get(counterparty, ())
+        return [
+            rule for rule in candidates
+            if rule.chat_id not in denied
+            and (rule.allow is None or rule.chat_id in allowed)
+            and not rule.is_quiet(clock)
+        ]
+
+class RuleIndex:
+    """Compiled alert rules for all users, keyed by watched address.
+
+    Users are only grouped by address up front, as compact
+    [chat_id, alert_tx_in, alert_tx_out, rules] entries; an address's rules
+    are compiled the first time a transaction touches it, which keeps
+    startup linear and cheap for large subscriber counts.
+    """
+    
+    def __init__(self, by_address: Dict[str, List[list]]):
+        self.by_address = by_address
+        self.addresses = set(by_address)
+        self.chat_ids = [entry[0] for entries in by_address.values() for entry in entries]
+        self.compiled: Dict[str, tuple] = {}
+    
+    @classmethod
+    def from_users(cls, users: List[Dict]) -> 'RuleIndex':
+        by_address: Dict[str, List[list]] = {}
+        for user in users:
+            address = user.get('eth_address') or user.get('io_address')
+            if address and address.startswith('io'):
+                address = AddressConverter.io_to_eth(address)
+            if not address:
+                logger.error(f"Could not convert address for user {user['chat_id']}")
+                continue
+            by_address.setdefault(address.lower(), []).append(
+                [user['chat_id'], user['alert_tx_in'], user['alert_tx_out'], user['rules']]
+            )
+        return cls(by_address)
+    
+    def compile(self, address: str) -> tuple:
+        """Return (incoming, outgoing) AddressRules for a watched address"""
+        compiled = self.compiled.get(address)
+        if compiled is None:
+            rules = [AlertRule(entry, address) for entry in self.by_address[address]]
+            compiled = (
+                AddressRules([r for r in rules if r.tx_in]),
+                AddressRules([r for r in rules if r.tx_out])
+            )
+            self.compiled[address] = compiled
+        return compiled
+    
+    def match(self, tx: Dict, clock: LocalClock) -> List[tuple]:
+        """Return (rule, is_incoming) for every rule that should alert on tx"""
+        from_addr = tx.get('from') or ''
+        to_addr = tx.get('to') or ''
+        value = tx.get('value', 0)
+        if from_addr == to_addr:
+            return []
+        
+        matches = []
+        if to_addr in self.addresses:
+            incoming = self.compile(to_addr)[0]
+            matches.extend((rule, True) for rule in incoming.match(value, from_addr, clock))
+        if from_addr in self.addresses:
+            outgoing = self.compile(from_addr)[1]
+            matches.extend((rule, False) for rule in outgoing.match(value, to_addr, clock))
+        return matches
+
+class AlertRenderer:
+    """Renders alert messages once and shares them across recipients.
+
+    Messages are cached per (tx hash, direction, timezone) and formatted
+    timestamps per (block timestamp, timezone), so fanning one tx out to
+    many chats costs one render per distinct timezone.
+    """
+    
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.messages: OrderedDict = OrderedDict()
+        self.timestamps: OrderedDict = OrderedDict()
+        self.timezones: Dict[str, object] = {}
+        self.lock = Lock()
+    
+    def _cached(self, cache: OrderedDict, key, build):
+        with self.lock:
+            value = cache.get(key)
+            if value is not None:
+                cache.move_to_end(key)
+                return value
+        
+        value = build()
+        with self.lock:
+            cache[key] = value
+            if len(cache) > self.max_entries:
+                cache.popitem(last=False)
+        return value
+    
+    def timezone(self, tz_name: str):
+        tz = self.timezones.get(tz_name)
+        if tz is None:
+            tz = self.timezones[tz_name] = pytz.timezone(tz_name)
+        return tz
+    
+    def format_timestamp(self, timestamp: int, tz_name: str) -> str:
+        """Format timestamp in the given timezone"""
+        return self._cached(
+            self.timestamps, (timestamp, tz_name),
+            lambda: datetime.fromtimestamp(timestamp, tz=self.timezone(tz_name)).strftime('%Y-%m-%d %H:%M:%S %Z')
+        )
+    
+    @staticmethod
+    def shorten_address(address: str) -> str:
+        """Shorten address for display"""
+        if len(address) > 15:
+            return f"{address[:6]}...{address[-4:]}"
+        return address
+    
+    def render_transaction(self, tx: Dict, is_incoming: bool, tz_name: str) -> str:
+        """Render a transaction alert"""
+        return self._cached(
+            self.messages, (tx.get('hash'), is_incoming, tz_name),
+            lambda: self._render_transaction(tx, is_incoming, tz_name)
+        )
+    
+    def _render_transaction(self, tx: Dict, is_incoming: bool, tz_name: str) -> str:
+        value = tx.get('value', 0)
+        amount_iotx = float(value) / 1e18
+        tx_hash = tx.get('hash', 'unknown')
+        from_addr = (tx.get('from') or '').lower()
+        to_addr = (tx.get('to') or '').lower()
+        timestamp = int(tx.get('timestamp', 0))
+        block_num = tx.get('blockNumber', 'unknown')
+        
+        explorer_url = f"https://iotexscan.io/tx/{tx_hash}"
+        
+        if is_incoming:
+            emoji = "📥"
+            direction = "Incoming Transaction"
+            other_addr = from_addr
+            label = "From"
+        else:
+            emoji = "📤"
+            direction = "Outgoing Transaction"
+            other_addr = to_addr
+            label = "To"
+        
+        return f"""
+{emoji} <b>{direction}</b>
+
+👤 <b>{label}:</b> <code>{self.shorten_address(other_addr)}</code>
+💰 <b>Amount:</b> {amount_iotx:.4f} IOTX
+🔗 <b>Transaction:</b> <a href="{explorer_url}">View on Explorer</a>
+📦 <b>Block:</b> {block_num}
+🕐 <b>Time:</b> {self.format_timestamp(timestamp, tz_name)}
+"""
+    
+    def render_reward(self, reward_info: Dict) -> str:
+        """Render a staking reward alert"""
+        return self._cached(
+            self.messages, ('reward', reward_info.get('tx_hash')),
+            lambda: self._render_reward(reward_info)
+        )
+    
+    def _render_reward(self, reward_info: Dict) -> str:
+        amount = reward_info.get('amount', 0)
+        validator_name = reward_info.get('validator_name', 'Unknown')
+        tx_hash = reward_info.get('tx_hash', 'unknown')
+        
+        explorer_url = f"https://iotexscan.io/tx/{tx_hash}"
+        
+        return f"""
+🎉 <b>Staking Reward Received!</b>
+
+💰 <b>Amount:</b> {amount} IOTX
+🏛 <b>Validator:</b> {validator_name}
+🔍 <a href="{explorer_url}">View on Explorer</a>
+"""
+
+class MultipartFile:
+    """A multipart/form-data body that streams one file from disk.
+
+    requests reads files passed via files= fully into memory to build the
+    body; this yields the file in chunks and reports its length up front
+    so the upload is sent with a Content-Length instead.
+    """
+    
+    def __init__(self, fields: Dict, name: str, filename: str, path: str,
+                 chunk_size: int = 64 * 1024):
+        boundary = os.urandom(16).hex()
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self.path = path
+        self.chunk_size = chunk_size
+        
+        head = ''.join(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'
+            for key, value in fields.items()
+        )
+        head += (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        )
+        self.head = head.encode()
+        self.tail = f'\r\n--{boundary}--\r\n'.encode()
+    
+    def __len__(self) -> int:
+        return len(self.head) + os.path.getsize(self.path) + len(self.tail)
+    
+    def __iter__(self):
+        yield self.head
+        with open(self.path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        yield self.tail
 
 class TelegramBot:
     def __init__(self, db: Database, iotex_api: IoTeXAPI):
         self.db = db
         self.iotex_api = iotex_api
         self.offset = 0
+        self.balance_cache = BalanceCache(BALANCE_CACHE_TTL_SEC)
+        self.rule_index: Optional[RuleIndex] = None
+        self.cursors: Optional[Dict[int, int]] = None
+        # Guards rule_index, users_generation and cursors, which commands and
+        # the scanner update from different threads
+        self.state_lock = Lock()
+        self.users_generation = 0
+        self.recent_blocks: OrderedDict = OrderedDict()
+        self.outbox_event = Event()
+        self.send_gate = SendGate(TELEGRAM_RATE_PER_SEC)
+        self.command_queue = queue.Queue(maxsize=COMMAND_QUEUE_SIZE)
+        self.export_queue = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+        self.backlog = 0
+        self.renderer = AlertRenderer(RENDER_CACHE_SIZE)
     
-    def send_message(self, chat_id: int, text: str, parse_mode: str = 'HTML'):
+    def send_message(self, chat_id: int, text: str, parse_mode: str = 'HTML',
+                     priority: int = PRIORITY_COMMAND):
         """Send message to user"""
         try:
+            with tracer.span('send_wait'):
+                self.send_gate.acquire(priority)
             payload = {
                 'chat_id': chat_id,
                 'text': text,
                 'parse_mode': parse_mode,
                 'disable_web_page_preview': True
             }
-            response = requests.post(f"{TELEGRAM_API}/sendMessage", json=payload)
+            with tracer.span('telegram'):
+                response = requests.post(f"{TELEGRAM_API}/sendMessage", json=payload)
             return response.status_code == 200
         except Exception as e:
             logger.error(f"Error sending message: {e}")
@@ -421,6 +1228,10 @@ or
 <b>Available Commands:</b>
 /setaddress - Set your IoTeX address
 /getaddress - View your saved address
+/balance - Check your IOTX balance
+/portfolio - Balances for several addresses
+/history - Recent transactions
+/export - Download your transaction history
 /settings - Customize alert preferences
 /unsubscribe - Stop all alerts
 /help - Show this message
@@ -461,6 +1272,10 @@ Let's get started! 🚀
         current_block = self.iotex_api.get_current_block()
         if current_block:
             self.db.update_last_block(chat_id, current_block)
+            with self.state_lock:
+                if self.cursors is not None:
+                    self.cursors[chat_id] = current_block
+        self.invalidate_rules()
         
         display_addr = io_addr if io_addr else eth_addr
         text = f"""
@@ -531,13 +1346,22 @@ Current settings:
 • Staking Rewards: {'✅ ON' if user['alert_rewards'] else '❌ OFF'}
 • Incoming TX: {'✅ ON' if user['alert_tx_in'] else '❌ OFF'}
 • Outgoing TX: {'✅ ON' if user['alert_tx_out'] else '❌ OFF'}
-
+{self.format_rules(user['rules'])}
 <b>Change settings:</b>
 <code>/settings all</code> - Enable all alerts
 <code>/settings rewards</code> - Toggle rewards only
 <code>/settings tx_in</code> - Toggle incoming TX
 <code>/settings tx_out</code> - Toggle outgoing TX
 <code>/settings none</code> - Disable all alerts
+
+<b>Filters:</b>
+<code>/settings min 10</code> - Only alert for 10 IOTX or more
+<code>/settings allow io1...</code> - Only alert for these counterparties
+<code>/settings deny io1...</code> - Never alert for this counterparty
+<code>/settings allow clear</code> / <code>/settings deny clear</code>
+<code>/settings quiet 23:00-07:00</code> - Mute alerts
+<code>/settings quiet off</code>
+<code>/settings tz Europe/Berlin</code> - Timezone for alerts and quiet hours
 """
             self.send_message(chat_id, text)
             return
@@ -545,7 +1369,10 @@ Current settings:
         # Handle setting changes
         args = args.lower().strip()
         
-        if args == 'all':
+        option, _, value = args.partition(' ')
+        if option in ('min', 'allow', 'deny', 'quiet', 'tz'):
+            self.handle_rule_setting(chat_id, user['rules'], option, value.strip())
+        elif args == 'all':
             self.db.update_settings(chat_id, 1, 1, 1)
             self.send_message(chat_id, "✅ All alerts enabled!")
         elif args == 'none':
@@ -565,6 +1392,365 @@ Current settings:
             self.send_message(chat_id, f"✅ Outgoing TX alerts {'enabled' if new_val else 'disabled'}!")
         else:
             self.send_message(chat_id, "❌ Invalid option. Use /settings to see available options.")
+        
+        self.invalidate_rules()
+    
+    def handle_rule_setting(self, chat_id: int, rules: Dict, option: str, value: str):
+        """Update one of the alert filter rules"""
+        if option == 'min':
+            try:
+                amount = Decimal(value)
+                if not amount.is_finite() or not 0 <= amount <= IOTX_TOTAL_SUPPLY:
+                    raise InvalidOperation
+            except InvalidOperation:
+                self.send_message(chat_id, "❌ Usage: <code>/settings min 10</code>")
+                return
+            rules['min'] = str(int(amount * 10 ** 18))
+            reply = f"✅ Minimum alert amount set to {amount} IOTX"
+        
+        elif option in ('allow', 'deny'):
+            if value == 'clear':
+                rules.pop(option, None)
+                reply = f"✅ {option.capitalize()} list cleared"
+            else:
+                if not AddressConverter.validate_address(value):
+                    self.send_message(chat_id, "❌ Invalid address format.")
+                    return
+                _, eth_addr = AddressConverter.normalize_address(value)
+                if not eth_addr:
+                    self.send_message(chat_id, "❌ Failed to process address. Please try again.")
+                    return
+                entries = rules.setdefault(option, [])
+                if eth_addr not in entries:
+                    entries.append(eth_addr)
+                reply = f"✅ Added <code>{self.shorten_address(value)}</code> to your {option} list"
+        
+        elif option == 'tz':
+            try:
+                tz_name = pytz.timezone(value).zone if value else None
+            except pytz.UnknownTimeZoneError:
+                tz_name = None
+            if not tz_name:
+                self.send_message(chat_id, "❌ Unknown timezone. Example: <code>/settings tz Europe/Berlin</code>")
+                return
+            rules['tz'] = tz_name
+            reply = f"✅ Timezone set to {tz_name}"
+        
+        else:
+            if value == 'off':
+                rules.pop('quiet', None)
+                reply = "✅ Quiet hours disabled"
+            else:
+                try:
+                    start, end = [datetime.strptime(t, '%H:%M') for t in value.split('-')]
+                except ValueError:
+                    self.send_message(chat_id, "❌ Usage: <code>/settings quiet 23:00-07:00</code>")
+                    return
+                rules['quiet'] = [start.hour * 60 + start.minute, end.hour * 60 + end.minute]
+                reply = f"✅ Quiet hours set to {value}"
+        
+        self.db.update_rules(chat_id, rules)
+        self.send_message(chat_id, reply)
+    
+    def format_rules(self, rules: Dict) -> str:
+        """Describe active alert filters"""
+        lines = []
+        if int(rules.get('min', 0)):
+            lines.append(f"• Minimum amount: {self.format_amount(int(rules['min']))}")
+        if rules.get('allow'):
+            lines.append(f"• Only from/to: {', '.join(self.shorten_address(a) for a in rules['allow'])}")
+        if rules.get('deny'):
+            lines.append(f"• Ignoring: {', '.join(self.shorten_address(a) for a in rules['deny'])}")
+        if rules.get('quiet'):
+            start, end = rules['quiet']
+            lines.append(f"• Quiet hours: {start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}")
+        if rules.get('tz'):
+            lines.append(f"• Timezone: {rules['tz']}")
+        return '\n' + '\n'.join(lines) + '\n' if lines else ''
+    
+    def get_balances(self, addresses: List[str]) -> Dict[str, Optional[int]]:
+        """Get balances from cache, fetching any misses in one batch"""
+        balances = {}
+        misses = []
+        for address in addresses:
+            cached = self.balance_cache.get(address)
+            if cached:
+                balances[address] = cached[0]
+            else:
+                misses.append(address)
+
+        if misses:
+            # Only one caller fetches at a time; others re-check the cache
+            # afterwards so a burst of requests costs a single round trip
+            with self.balance_cache.fetch_lock:
+                still_missing = []
+                for address in misses:
+                    cached = self.balance_cache.get(address)
+                    if cached:
+                        balances[address] = cached[0]
+                    else:
+                        still_missing.append(address)
+
+                if still_missing:
+                    block, fetched = self.iotex_api.get_balances(still_missing)
+                    for address in still_missing:
+                        balance = fetched.get(address)
+                        if balance is not None:
+                            self.balance_cache.put(address, block, balance)
+                        balances[address] = balance
+
+        return balances
+
+    def refresh_balances(self):
+        """Warm the balance cache for every tracked address"""
+        self.balance_cache.prune()
+        # The scanner's index already holds the deduplicated 0x addresses
+        addresses = list(self.get_rule_index().addresses)
+
+        if not addresses:
+            return
+
+        block, fetched = self.iotex_api.get_balances(addresses)
+        for address, balance in fetched.items():
+            self.balance_cache.put(address, block, balance)
+        logger.info(f"Refreshed {len(fetched)}/{len(addresses)} balances at block {block}")
+
+    def get_rpc_address(self, user: Dict) -> Optional[str]:
+        """Return the user's address in 0x format for RPC calls"""
+        address = user.get('eth_address') or user.get('io_address')
+        if address and address.startswith('io'):
+            address = AddressConverter.io_to_eth(address)
+        return address.lower() if address else None
+
+    def format_amount(self, rau: int) -> str:
+        """Format RAU amount as IOTX"""
+        return f"{float(rau) / 1e18:.4f} IOTX"
+
+    def handle_balance(self, chat_id: int):
+        """Handle /balance command"""
+        user = self.db.get_user(chat_id)
+
+        if not user or not user.get('io_address'):
+            self.send_message(
+                chat_id,
+                "❌ Please set your address first using /setaddress"
+            )
+            return
+
+        address = self.get_rpc_address(user)
+        balance = self.get_balances([address]).get(address) if address else None
+
+        if balance is None:
+            self.send_message(chat_id, "❌ Could not fetch your balance. Please try again later.")
+            return
+
+        text = f"""
+💰 <b>Balance</b>
+
+📍 <code>{user['io_address']}</code>
+<b>{self.format_amount(balance)}</b>
+"""
+        self.send_message(chat_id, text)
+
+    def handle_portfolio(self, chat_id: int, args: str = ''):
+        """Handle /portfolio command"""
+        user = self.db.get_user(chat_id)
+
+        addresses = []
+        if user and user.get('io_address'):
+            addresses.append(user['io_address'])
+        addresses.extend(args.split())
+
+        if not addresses:
+            self.send_message(
+                chat_id,
+                "❌ Please provide addresses or set one using /setaddress\n\n"
+                "Usage: <code>/portfolio io1abc... 0xdef...</code>"
+            )
+            return
+
+        if len(addresses) > PORTFOLIO_MAX_ADDRESSES:
+            self.send_message(chat_id, f"❌ At most {PORTFOLIO_MAX_ADDRESSES} addresses per /portfolio")
+            return
+
+        entries = []
+        for address in addresses:
+            if not AddressConverter.validate_address(address):
+                self.send_message(chat_id, f"❌ Invalid address: <code>{html.escape(address)}</code>")
+                return
+            io_addr, eth_addr = AddressConverter.normalize_address(address)
+            if not eth_addr:
+                self.send_message(chat_id, f"❌ Failed to process address: <code>{html.escape(address)}</code>")
+                return
+            if eth_addr not in [e[1] for e in entries]:
+                entries.append((io_addr or eth_addr, eth_addr))
+
+        balances = self.get_balances([eth_addr for _, eth_addr in entries])
+
+        lines = []
+        total = 0
+        for display_addr, eth_addr in entries:
+            balance = balances.get(eth_addr)
+            if balance is None:
+                lines.append(f"• <code>{self.shorten_address(display_addr)}</code>: unavailable")
+            else:
+                total += balance
+                lines.append(f"• <code>{self.shorten_address(display_addr)}</code>: {self.format_amount(balance)}")
+
+        text = "💼 <b>Portfolio</b>\n\n" + "\n".join(lines) + f"\n\n<b>Total:</b> {self.format_amount(total)}"
+        self.send_message(chat_id, text)
+
+    def handle_history(self, chat_id: int, args: str = ''):
+        """Handle /history command"""
+        user = self.db.get_user(chat_id)
+
+        if not user or not user.get('io_address'):
+            self.send_message(
+                chat_id,
+                "❌ Please set your address first using /setaddress"
+            )
+            return
+
+        parts = args.split()
+        try:
+            limit = int(parts[0]) if parts else HISTORY_PAGE_SIZE
+            before = tuple(int(p) for p in parts[1].split(':')) if len(parts) > 1 else None
+            if before is not None and len(before) != 2:
+                raise ValueError
+        except ValueError:
+            self.send_message(chat_id, "❌ Usage: <code>/history [n]</code>")
+            return
+        limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+        address = self.get_rpc_address(user)
+        rows = self.db.get_history(address, limit, before)
+
+        if not rows:
+            self.send_message(chat_id, "📭 No transactions recorded yet." if not before else "📭 No older transactions.")
+            return
+
+        lines = []
+        for tx in rows:
+            is_incoming = tx['to'] == address
+            emoji = "📥" if is_incoming else "📤"
+            other_addr = tx['from'] if is_incoming else tx['to']
+            lines.append(
+                f"{emoji} {self.format_amount(tx['value'])} "
+                f"{'from' if is_incoming else 'to'} <code>{self.shorten_address(other_addr or '')}</code>\n"
+                f"    📦 {tx['blockNumber']} · <a href=\"https://iotexscan.io/tx/{tx['hash']}\">{self.shorten_address(tx['hash'])}</a>"
+            )
+
+        text = "📜 <b>Transaction History</b>\n\n" + "\n".join(lines)
+        if len(rows) == limit:
+            last = rows[-1]
+            text += f"\n\nOlder: <code>/history {limit} {last['blockNumber']}:{last['id']}</code>"
+        self.send_message(chat_id, text)
+
+    def export_history(self, address: str, fmt: str, out, max_bytes: int = EXPORT_MAX_BYTES) -> bool:
+        """Stream history rows for an address to a text file as CSV or JSONL.
+
+        Returns False, leaving a partial file, once the output grows past
+        max_bytes.
+        """
+        fields = ['blockNumber', 'timestamp', 'hash', 'from', 'to', 'value', 'gasPrice', 'gasUsed']
+        if fmt == 'csv':
+            writer = csv.writer(out)
+            writer.writerow(fields)
+        
+        for i, tx in enumerate(self.db.iter_history(address), 1):
+            if fmt == 'csv':
+                writer.writerow([tx[f] for f in fields])
+            else:
+                # Keep RAU values as strings so JSON consumers don't lose precision
+                row = {f: tx[f] for f in fields}
+                row['value'] = str(row['value'])
+                row['gasPrice'] = str(row['gasPrice'])
+                out.write(json.dumps(row) + '\n')
+            if i % 1000 == 0 and out.tell() > max_bytes:
+                return False
+        return out.tell() <= max_bytes
+
+    def send_document(self, chat_id: int, path: str, filename: str):
+        """Upload a file to user, streaming it from disk"""
+        try:
+            body = MultipartFile({'chat_id': chat_id}, 'document', filename, path)
+            response = requests.post(
+                f"{TELEGRAM_API}/sendDocument",
+                data=body,
+                headers={'Content-Type': body.content_type}
+            )
+            return response.status_code == 200
+        except Exception as e:
+            logger.error(f"Error sending document: {e}")
+            return False
+
+    def handle_export(self, chat_id: int, args: str = ''):
+        """Handle /export command"""
+        user = self.db.get_user(chat_id)
+
+        if not user or not user.get('io_address'):
+            self.send_message(
+                chat_id,
+                "❌ Please set your address first using /setaddress"
+            )
+            return
+
+        fmt = args.lower().strip() or 'csv'
+        if fmt not in ('csv', 'jsonl'):
+            self.send_message(chat_id, "❌ Usage: <code>/export csv</code> or <code>/export jsonl</code>")
+            return
+
+        # Large exports take a while to write and upload; keep them off
+        # the command thread
+        job = (chat_id, self.get_rpc_address(user), fmt, f"iotex_history_{user['io_address']}.{fmt}")
+        try:
+            self.export_queue.put_nowait(job)
+        except queue.Full:
+            self.send_message(chat_id, "❌ Too many exports in progress. Please try again later.")
+            return
+        self.send_message(chat_id, "⏳ Preparing your export...")
+    
+    def run_exports(self):
+        """Export worker loop; writes and uploads queued /export requests"""
+        while True:
+            chat_id, address, fmt, filename = self.export_queue.get()
+            try:
+                self.send_export(chat_id, address, fmt, filename)
+            except Exception as e:
+                logger.error(f"Error exporting history for {chat_id}: {e}")
+                self.send_message(chat_id, "❌ Could not send the export. Please try again later.")
+    
+    def send_export(self, chat_id: int, address: str, fmt: str, filename: str):
+        """Write an export to a temp file and upload it"""
+        f = tempfile.NamedTemporaryFile('w', suffix=f'.{fmt}', newline='', delete=False)
+        try:
+            with f:
+                complete = self.export_history(address, fmt, f)
+            if not complete:
+                self.send_message(
+                    chat_id,
+                    f"❌ Your history is larger than Telegram's {EXPORT_MAX_BYTES // (1024 * 1024)} MB "
+                    "upload limit. Use /history to browse it instead."
+                )
+            elif not self.send_document(chat_id, f.name, filename):
+                self.send_message(chat_id, "❌ Could not send the export. Please try again later.")
+        finally:
+            os.remove(f.name)
+
+    def handle_profile(self, chat_id: int, args: str = ''):
+        """Handle /profile command (admin only)"""
+        try:
+            cycles = int(args) if args.strip() else 1
+            if cycles < 1:
+                raise ValueError
+        except ValueError:
+            self.send_message(chat_id, f"❌ Usage: <code>/profile [cycles]</code> (1-{PROFILE_MAX_CYCLES})")
+            return
+        cycles = min(cycles, PROFILE_MAX_CYCLES)
+        
+        tracer.request_profile(cycles)
+        self.send_message(chat_id, f"✅ Profiling the next {cycles} monitor cycle(s) into <code>{PROFILE_DIR}</code>")
+        logger.info(f"Admin {chat_id} requested profiling for {cycles} cycle(s)")
     
     def handle_unsubscribe(self, chat_id: int):
         """Handle /unsubscribe command"""
@@ -575,6 +1761,10 @@ Current settings:
             return
         
         self.db.delete_user(chat_id)
+        with self.state_lock:
+            if self.cursors is not None:
+                self.cursors.pop(chat_id, None)
+        self.invalidate_rules()
         text = """
 ✅ <b>Successfully unsubscribed</b>
 
@@ -602,6 +1792,10 @@ Thank you for using IoTeX Alert Bot! 👋
 /start - Start the bot and get instructions
 /setaddress - Set/update your IoTeX address
 /getaddress - View your saved address
+/balance - Check your IOTX balance
+/portfolio - Balances for several addresses
+/history - Recent transactions
+/export - Download your transaction history
 /settings - Customize alert preferences
 /unsubscribe - Stop all alerts and delete data
 /help - Show this help message
@@ -610,6 +1804,10 @@ Thank you for using IoTeX Alert Bot! 👋
 <code>/setaddress io1abc123...</code>
 <code>/settings all</code>
 <code>/settings rewards</code>
+<code>/settings min 10</code>
+<code>/portfolio io1abc... 0xdef...</code>
+<code>/history 20</code>
+<code>/export jsonl</code>
 
 <b>Privacy:</b>
 We only store your chat ID and address. We never ask for private keys or seed phrases.
@@ -621,218 +1819,473 @@ For issues or questions, please contact the bot administrator.
 """
         self.send_message(chat_id, text)
     
+    def poll_updates(self):
+        """Ingest loop; a full command queue stops polling until it drains"""
+        while True:
+            updates = self.get_updates()
+            if not updates:
+                time.sleep(1)
+            for update in updates:
+                self.offset = update['update_id'] + 1
+                self.command_queue.put(update)
+    
     def process_updates(self):
-        """Process incoming Telegram updates"""
-        updates = self.get_updates()
-        
-        for update in updates:
-            self.offset = update['update_id'] + 1
-            
-            if 'message' not in update:
-                continue
-            
-            message = update['message']
-            chat_id = message['chat']['id']
-            text = message.get('text', '')
-            
-            if not text.startswith('/'):
-                continue
-            
-            parts = text.split(maxsplit=1)
-            command = parts[0].lower().replace(f'@{BOT_TOKEN.split(":")[0]}', '')
-            args = parts[1] if len(parts) > 1 else ''
-            
+        """Process queued Telegram updates"""
+        try:
+            updates = [self.command_queue.get(timeout=1)]
+        except queue.Empty:
+            return
+        while len(updates) < 100:
             try:
-                if command == '/start':
-                    self.handle_start(chat_id)
-                elif command == '/setaddress':
-                    self.handle_setaddress(chat_id, args)
-                elif command == '/getaddress':
-                    self.handle_getaddress(chat_id)
-                elif command == '/settings':
-                    self.handle_settings(chat_id, args)
-                elif command == '/unsubscribe':
-                    self.handle_unsubscribe(chat_id)
-                elif command == '/help':
-                    self.handle_help(chat_id)
-                else:
-                    self.send_message(chat_id, "Unknown command. Use /help to see available commands.")
-            except Exception as e:
-                logger.error(f"Error processing command {command}: {e}")
-                self.send_message(chat_id, "An error occurred. Please try again later.")
-    
-    def format_timestamp(self, timestamp: int) -> str:
-        """Format timestamp to local timezone"""
-        dt = datetime.fromtimestamp(timestamp, tz=TIMEZONE)
-        return dt.strftime('%Y-%m-%d %H:%M:%S %Z')
+                updates.append(self.command_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        with tracer.cycle('updates'):
+            for update in updates:
+                if 'message' not in update:
+                    continue
+                
+                message = update['message']
+                chat_id = message['chat']['id']
+                text = message.get('text', '')
+                
+                if not text.startswith('/'):
+                    continue
+                
+                parts = text.split(maxsplit=1)
+                command = parts[0].lower().replace(f'@{BOT_TOKEN.split(":")[0]}', '')
+                args = parts[1] if len(parts) > 1 else ''
+                
+                try:
+                    if command == '/start':
+                        self.handle_start(chat_id)
+                    elif command == '/setaddress':
+                        self.handle_setaddress(chat_id, args)
+                    elif command == '/getaddress':
+                        self.handle_getaddress(chat_id)
+                    elif command == '/balance':
+                        self.handle_balance(chat_id)
+                    elif command == '/portfolio':
+                        self.handle_portfolio(chat_id, args)
+                    elif command == '/history':
+                        self.handle_history(chat_id, args)
+                    elif command == '/export':
+                        self.handle_export(chat_id, args)
+                    elif command == '/settings':
+                        self.handle_settings(chat_id, args)
+                    elif command == '/unsubscribe':
+                        self.handle_unsubscribe(chat_id)
+                    elif command == '/help':
+                        self.handle_help(chat_id)
+                    elif command == '/profile' and chat_id in ADMIN_CHAT_IDS:
+                        self.handle_profile(chat_id, args)
+                    else:
+                        self.send_message(chat_id, "Unknown command. Use /help to see available commands.")
+                except Exception as e:
+                    logger.error(f"Error processing command {command}: {e}")
+                    self.send_message(chat_id, "An error occurred. Please try again later.")
+        
+    def format_timestamp(self, timestamp: int, tz_name: Optional[str] = None) -> str:
+        """Format timestamp to the user's or the bot's timezone"""
+        return self.renderer.format_timestamp(timestamp, tz_name or TIMEZONE.zone)
     
     def shorten_address(self, address: str) -> str:
         """Shorten address for display"""
-        if len(address) > 15:
-            return f"{address[:6]}...{address[-4:]}"
-        return address
+        return self.renderer.shorten_address(address)
     
-    def send_transaction_alert(self, chat_id: int, tx: Dict, user_address: str, is_incoming: bool):
+    def send_transaction_alert(self, chat_id: int, tx: Dict, user_address: str, is_incoming: bool,
+                               tz_name: Optional[str] = None):
         """Send transaction alert"""
-        value = tx.get('value', 0)
-        amount_iotx = float(value) / 1e18
-        tx_hash = tx.get('hash', 'unknown')
-        from_addr = tx.get('from', '').lower()
-        to_addr = tx.get('to', '').lower()
-        timestamp = int(tx.get('timestamp', 0))
-        block_num = tx.get('blockNumber', 'unknown')
-        
-        explorer_url = f"https://iotexscan.io/tx/{tx_hash}"
+        text = self.renderer.render_transaction(tx, is_incoming, tz_name or TIMEZONE.zone)
         
-        if is_incoming:
-            emoji = "📥"
-            direction = "Incoming Transaction"
-            other_addr = from_addr
-            label = "From"
-        else:
-            emoji = "📤"
-            direction = "Outgoing Transaction"
-            other_addr = to_addr
-            label = "To"
-        
-        text = f"""
-{emoji} <b>{direction}</b>
-
-👤 <b>{label}:</b> <code>{self.shorten_address(other_addr)}</code>
-💰 <b>Amount:</b> {amount_iotx:.4f} IOTX
-🔗 <b>Transaction:</b> <a href="{explorer_url}">View on Explorer</a>
-📦 <b>Block:</b> {block_num}
-🕐 <b>Time:</b> {self.format_timestamp(timestamp)}
-"""
-        
-        self.send_message(chat_id, text)
-        logger.info(f"Sent {'incoming' if is_incoming else 'outgoing'} TX alert to {chat_id}")
+        sent = self.send_message(chat_id, text, priority=PRIORITY_ALERT)
+        if sent:
+            logger.info(f"Sent {'incoming' if is_incoming else 'outgoing'} TX alert to {chat_id}")
+        return sent
     
     def send_reward_alert(self, chat_id: int, reward_info: Dict):
         """Send staking reward alert"""
-        amount = reward_info.get('amount', 0)
-        validator_name = reward_info.get('validator_name', 'Unknown')
-        tx_hash = reward_info.get('tx_hash', 'unknown')
-        
-        explorer_url = f"https://iotexscan.io/tx/{tx_hash}"
+        text = self.renderer.render_reward(reward_info)
         
-        text = f"""
-🎉 <b>Staking Reward Received!</b>
+        self.send_message(chat_id, text, priority=PRIORITY_ALERT)
+        logger.info(f"Sent reward alert to {chat_id}")
+    
+    def invalidate_rules(self):
+        """Drop the rule index after a committed user change"""
+        with self.state_lock:
+            self.users_generation += 1
+            self.rule_index = None
+    
+    def get_rule_index(self) -> RuleIndex:
+        """Return the compiled rule index, rebuilding it after user changes.
 
-💰 <b>Amount:</b> {amount} IOTX
-🏛 <b>Validator:</b> {validator_name}
-🔍 <a href="{explorer_url}">View on Explorer</a>
-"""
+        An index built while another change landed is used for this cycle
+        but not kept, so the next cycle rebuilds from current data.
+        """
+        with self.state_lock:
+            index = self.rule_index
+            generation = self.users_generation
+        if index is not None:
+            return index
         
-        self.send_message(chat_id, text)
-        logger.info(f"Sent reward alert to {chat_id}")
+        with tracer.span('sqlite'):
+            users = self.db.get_all_users()
+        index = RuleIndex.from_users(users)
+        
+        with self.state_lock:
+            if self.users_generation == generation:
+                self.rule_index = index
+        return index
     
     def monitor_transactions(self):
-        """Monitor transactions for all users"""
-        users = self.db.get_all_users()
+        """Monitor transactions for all users with a single scan"""
+        index = self.get_rule_index()
         current_block = self.iotex_api.get_current_block()
         
         if not current_block:
             logger.warning("Could not get current block, skipping this cycle")
             return
         
-        for user in users:
-            chat_id = user['chat_id']
-            address = user['eth_address'] or user['io_address']
-            
-            if not address:
-                continue
+        if self.cursors is None:
+            with tracer.span('sqlite'):
+                last_blocks = self.db.get_last_blocks()
+            with self.state_lock:
+                if self.cursors is None:
+                    self.cursors = last_blocks
+        
+        # Start from 10 blocks ago for new users
+        initial_block = max(current_block - 10, 1)
+        with self.state_lock:
+            new_users = [chat_id for chat_id in index.chat_ids if not self.cursors.get(chat_id)]
+            for chat_id in new_users:
+                self.cursors[chat_id] = initial_block
+        if new_users:
+            with tracer.span('sqlite'):
+                self.db.init_last_blocks(new_users, initial_block)
+            logger.info(f"Initialized last block for {len(new_users)} user(s): {initial_block}")
+        
+        # Users can unsubscribe from the command thread while this runs
+        with self.state_lock:
+            cursors = {chat_id: self.cursors.get(chat_id) for chat_id in index.chat_ids}
+        cursors = {chat_id: block for chat_id, block in cursors.items() if block}
+        if not cursors:
+            return
+        
+        # Only check confirmed blocks
+        end_block = current_block - CONFIRMATIONS
+        last_block = min(cursors.values())
+        
+        if last_block >= end_block:
+            return
+        
+        # Back off as the delivery backlog grows, and stop taking on new
+        # blocks entirely once it passes PAUSE_BACKLOG
+        with tracer.span('sqlite'):
+            self.backlog = self.db.count_pending_outbox()
+        if self.backlog >= PAUSE_BACKLOG:
+            logger.warning(f"Delivery backlog at {self.backlog}, pausing scan")
+            return
+        max_blocks = max(1, int(MAX_SCAN_BLOCKS * (1 - self.backlog / PAUSE_BACKLOG)))
+        
+        # Limit range to prevent scanning too many blocks at once
+        start_block = last_block + 1
+        if end_block - start_block > max_blocks:
+            end_block = start_block + max_blocks
+        
+        try:
+            logger.info(f"Scanning blocks {start_block}-{end_block} for {len(index.addresses)} address(es)")
+            block_hashes = {}
+            transactions = self.iotex_api.get_transactions_from_blocks(
+                index.addresses, start_block, end_block, block_hashes
+            )
+            self.check_block_hashes(block_hashes)
+            clock = LocalClock(datetime.now(pytz.utc))
+            alerts = []
+            history = []
             
-            # Ensure address is in 0x format for RPC calls
-            if address.startswith('io'):
-                address = AddressConverter.io_to_eth(address)
-                if not address:
-                    logger.error(f"Could not convert address for user {chat_id}")
+            for tx in transactions:
+                tx_hash = tx.get('hash')
+                
+                # Any tx touching a tracked address makes its cached balance stale
+                for addr in (tx.get('from'), tx.get('to')):
+                    if addr:
+                        self.balance_cache.invalidate(addr, tx.get('blockNumber', 0))
+                
+                if not tx_hash:
                     continue
+                
+                for addr in (tx.get('from'), tx.get('to')):
+                    if addr in index.addresses:
+                        history.append((addr, tx))
+                
+                with tracer.span('rules'):
+                    matches = index.match(tx, clock)
+                
+                for rule, is_incoming in matches:
+                    # Users whose cursor is already past this block have seen it
+                    if tx['blockNumber'] <= cursors.get(rule.chat_id, end_block):
+                        continue
+                    
+                    alerts.append({
+                        'key': f"{rule.chat_id}:{tx_hash}:{'in' if is_incoming else 'out'}",
+                        'chat_id': rule.chat_id,
+                        'kind': 'tx',
+                        'payload': {
+                            'tx': tx,
+                            'address': rule.address,
+                            'is_incoming': is_incoming,
+                            'timezone': rule.tz
+                        }
+                    })
             
-            last_block = self.db.get_last_block(chat_id)
-            if not last_block:
-                # Start from 10 blocks ago for new users
-                last_block = max(current_block - 10, 1)
-                self.db.update_last_block(chat_id, last_block)
-                logger.info(f"Initialized last block for user {chat_id}: {last_block}")
-                continue
+            # Alerts, history and cursors land in one transaction, so a crash
+            # either replays the whole range or none of it
+            advanced = [chat_id for chat_id, block in cursors.items() if block < end_block]
+            with tracer.span('sqlite'):
+                self.db.commit_scan(alerts, history, advanced, end_block)
+            # Never move a cursor back, nor re-add one for a user who left
+            with self.state_lock:
+                for chat_id in advanced:
+                    if chat_id in self.cursors:
+                        self.cursors[chat_id] = max(self.cursors[chat_id], end_block)
+            logger.info(f"Queued {len(alerts)} alert(s), updated last block to {end_block}")
+            if alerts:
+                self.outbox_event.set()
             
-            # Only check confirmed blocks
-            end_block = current_block - CONFIRMATIONS
+        except Exception as e:
+            logger.error(f"Error monitoring transactions: {e}")
+
+    def check_block_hashes(self, block_hashes: Dict):
+        """Remember recent block hashes and warn if the chain no longer links up"""
+        for block_num in sorted(block_hashes):
+            block_hash, parent_hash = block_hashes[block_num]
+            known_parent = self.recent_blocks.get(block_num - 1)
+            if known_parent and parent_hash and known_parent != parent_hash:
+                logger.warning(f"Block {block_num} does not extend the scanned chain (reorg deeper than {CONFIRMATIONS} blocks?)")
+            self.recent_blocks[block_num] = block_hash
+        
+        while len(self.recent_blocks) > RECENT_BLOCKS:
+            self.recent_blocks.popitem(last=False)
+    
+    def load_state(self):
+        """Warm-start the rule index, cursors and block hashes.
+
+        The snapshot index is used only if its state revision still matches
+        the users table; otherwise it is rebuilt from the table. Cursors
+        always come from last_blocks.
+        """
+        start = time.perf_counter()
+        state_rev = self.db.get_state_rev()
+        snapshot = None
+        
+        try:
+            with open(SNAPSHOT_PATH) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable snapshot {SNAPSHOT_PATH}: {e}")
+        
+        if snapshot and snapshot.get('state_rev') == state_rev:
+            self.rule_index = RuleIndex(snapshot['index'])
+            source = 'snapshot'
+        else:
+            _, users = self.db.read_state()
+            self.rule_index = RuleIndex.from_users(users)
+            source = 'database'
+        self.cursors = self.db.get_last_blocks()
+        
+        if snapshot:
+            self.recent_blocks = OrderedDict((num, block_hash) for num, block_hash in snapshot.get('recent_blocks', []))
+            # Balances carry their own fetch time, so stale ones still expire
+            for address, block, balance, fetched_at in snapshot.get('balances', []):
+                self.balance_cache.entries[address] = (block, int(balance), fetched_at)
+        
+        logger.info(f"Loaded {len(self.rule_index.chat_ids)} user(s) from {source} in {(time.perf_counter() - start) * 1000:.0f} ms")
+    
+    def save_snapshot(self):
+        """Write a compact snapshot of the address index, recent block
+        hashes and cached balances"""
+        state_rev, users = self.db.read_state()
+        
+        snapshot = {
+            'state_rev': state_rev,
+            'index': RuleIndex.from_users(users).by_address,
+            'recent_blocks': list(self.recent_blocks.items()),
+            'balances': [
+                [address, block, str(balance), fetched_at]
+                for address, (block, balance, fetched_at) in list(self.balance_cache.entries.items())
+            ]
+        }
+        
+        tmp_path = SNAPSHOT_PATH + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        os.replace(tmp_path, SNAPSHOT_PATH)
+        logger.info(f"Wrote snapshot of {len(users)} user(s) at state revision {state_rev}")
+    
+    def deliver_outbox(self) -> int:
+        """Send one batch of pending outbox alerts, returning how many were tried"""
+        with tracer.span('sqlite'):
+            self.backlog = self.db.count_pending_outbox()
+        
+        # Degraded mode: collapse each chat's pending alerts into one digest
+        if self.backlog >= DIGEST_BACKLOG:
+            return self.deliver_digests()
+        
+        with tracer.span('sqlite'):
+            entries = self.db.get_pending_outbox(OUTBOX_BATCH_SIZE)
+        
+        for entry in entries:
+            payload = entry['payload']
+            try:
+                sent = self.send_transaction_alert(
+                    entry['chat_id'], payload['tx'], payload['address'], payload['is_incoming'],
+                    payload.get('timezone')
+                )
+            except Exception as e:
+                logger.error(f"Error delivering outbox entry {entry['id']}: {e}")
+                sent = False
             
-            if last_block >= end_block:
-                continue
+            with tracer.span('sqlite'):
+                if sent:
+                    self.db.mark_outbox_sent([entry['id']])
+                else:
+                    self.retry_outbox_entry(entry)
+        
+        return len(entries)
+    
+    def deliver_digests(self) -> int:
+        """Send one digest per chat for a batch of pending alerts"""
+        with tracer.span('sqlite'):
+            entries = self.db.get_pending_outbox(OUTBOX_BATCH_SIZE * 20)
+        
+        by_chat: Dict[int, List[Dict]] = {}
+        for entry in entries:
+            by_chat.setdefault(entry['chat_id'], []).append(entry)
+        
+        logger.warning(f"Delivery backlog at {self.backlog}, sending {len(by_chat)} digest(s)")
+        
+        for chat_id, chat_entries in by_chat.items():
+            incoming = [e['payload']['tx']['value'] for e in chat_entries if e['payload']['is_incoming']]
+            outgoing = [e['payload']['tx']['value'] for e in chat_entries if not e['payload']['is_incoming']]
+            latest = max(e['payload']['tx']['blockNumber'] for e in chat_entries)
+            
+            lines = [f"📬 <b>{len(chat_entries)} new transaction(s)</b>", ""]
+            if incoming:
+                lines.append(f"📥 {len(incoming)} incoming: {self.format_amount(sum(incoming))}")
+            if outgoing:
+                lines.append(f"📤 {len(outgoing)} outgoing: {self.format_amount(sum(outgoing))}")
+            lines.append(f"📦 Up to block {latest}")
+            lines.append("")
+            lines.append("Alerts are being batched due to high load. Use /history for details.")
             
-            # Limit range to prevent scanning too many blocks at once
-            start_block = last_block + 1
-            if end_block - start_block > 50:
-                end_block = start_block + 50
+            sent = self.send_message(chat_id, "\n".join(lines), priority=PRIORITY_DIGEST)
             
+            with tracer.span('sqlite'):
+                if sent:
+                    self.db.mark_outbox_sent([e['id'] for e in chat_entries])
+                else:
+                    for entry in chat_entries:
+                        self.retry_outbox_entry(entry)
+        
+        return len(entries)
+    
+    def retry_outbox_entry(self, entry: Dict):
+        """Schedule a failed outbox entry for retry with exponential backoff"""
+        attempts = entry['attempts'] + 1
+        retry_at = time.time() + min(2 ** attempts, 300) if attempts < OUTBOX_MAX_ATTEMPTS else None
+        self.db.mark_outbox_failed(entry['id'], attempts, retry_at)
+        if retry_at is None:
+            logger.error(f"Giving up on outbox entry {entry['id']} for {entry['chat_id']}")
+    
+    def run_delivery(self):
+        """Delivery worker loop; drains the outbox independently of scanning"""
+        last_prune = 0
+        
+        while True:
             try:
-                logger.info(f"Scanning blocks {start_block}-{end_block} for user {chat_id}")
-                transactions = self.iotex_api.get_transactions_from_blocks(address, start_block, end_block)
+                with tracer.cycle('delivery'):
+                    delivered = self.deliver_outbox()
                 
-                for tx in transactions:
-                    tx_hash = tx.get('hash')
-                    
-                    if not tx_hash or self.db.is_tx_processed(chat_id, tx_hash):
-                        continue
-                    
-                    from_addr = tx.get('from', '').lower()
-                    to_addr = tx.get('to', '').lower()
-                    user_addr = address.lower()
-                    
-                    is_incoming = to_addr == user_addr and from_addr != user_addr
-                    is_outgoing = from_addr == user_addr and to_addr != user_addr
-                    
-                    # Skip if amount is 0
-                    if tx.get('value', 0) == 0:
-                        self.db.mark_tx_processed(chat_id, tx_hash)
-                        continue
-                    
-                    if is_incoming and user['alert_tx_in']:
-                        self.send_transaction_alert(chat_id, tx, user_addr, True)
-                        self.db.mark_tx_processed(chat_id, tx_hash)
-                    elif is_outgoing and user['alert_tx_out']:
-                        self.send_transaction_alert(chat_id, tx, user_addr, False)
-                        self.db.mark_tx_processed(chat_id, tx_hash)
-                    else:
-                        self.db.mark_tx_processed(chat_id, tx_hash)
+                if time.time() - last_prune >= 3600:
+                    self.db.prune_outbox(OUTBOX_RETENTION_SEC)
+                    last_prune = time.time()
                 
-                self.db.update_last_block(chat_id, end_block)
-                logger.info(f"Updated last block for user {chat_id}: {end_block}")
+                if not delivered:
+                    self.outbox_event.wait(timeout=1)
+                    self.outbox_event.clear()
+            except Exception as e:
+                logger.error(f"Error in delivery worker: {e}")
+                time.sleep(5)
+    
+    def run_balance_refresh(self):
+        """Balance worker loop; keeps tracked balances warm for /balance and /portfolio"""
+        # Balances restored from the snapshot are still warm
+        if self.balance_cache.entries:
+            time.sleep(BALANCE_REFRESH_SEC)
+        
+        while True:
+            try:
+                self.refresh_balances()
+            except Exception as e:
+                logger.error(f"Error refreshing balances: {e}")
+            time.sleep(BALANCE_REFRESH_SEC)
+    
+    def run_scanner(self):
+        """Scanner loop: block scans and snapshots"""
+        last_monitor = 0
+        last_snapshot = time.time()
+        
+        while True:
+            try:
+                current_time = time.time()
+                if current_time - last_monitor >= POLL_INTERVAL_SEC:
+                    if not last_monitor:
+                        logger.info(f"Time to first scan: {(time.perf_counter() - STARTED_AT) * 1000:.0f} ms")
+                    with tracer.cycle('monitor', profile=True):
+                        self.monitor_transactions()
+                    last_monitor = current_time
                 
+                if current_time - last_snapshot >= SNAPSHOT_INTERVAL_SEC:
+                    self.save_snapshot()
+                    last_snapshot = current_time
+                
+                time.sleep(1)
             except Exception as e:
-                logger.error(f"Error monitoring transactions for {chat_id}: {e}")
+                logger.error(f"Error in scanner: {e}")
+                time.sleep(5)
 
 def run_bot():
-    """Main bot loop"""
+    """Start the pipeline threads and handle commands on the main thread.
+
+    Updates are ingested into a bounded command queue, the scanner writes
+    alerts to the outbox and the delivery worker drains it. Command replies
+    take priority over alerts, and alerts over digests, at the send gate.
+    """
     db = Database(DB_PATH)
     iotex_api = IoTeXAPI(IOTEX_RPC_URL)
     bot = TelegramBot(db, iotex_api)
+    bot.load_state()
+    
+    # Alerts left pending by a previous run are delivered on startup
+    Thread(target=bot.run_delivery, name='delivery', daemon=True).start()
+    Thread(target=bot.run_scanner, name='scanner', daemon=True).start()
+    Thread(target=bot.run_balance_refresh, name='balances', daemon=True).start()
+    Thread(target=bot.run_exports, name='exports', daemon=True).start()
+    Thread(target=bot.poll_updates, name='updates', daemon=True).start()
     
     logger.info("Bot started successfully!")
     logger.info(f"Polling interval: {POLL_INTERVAL_SEC}s")
     logger.info(f"Confirmations required: {CONFIRMATIONS}")
     logger.info(f"RPC URL: {IOTEX_RPC_URL}")
     
-    last_monitor = 0
-    
     while True:
         try:
-            # Process Telegram updates
             bot.process_updates()
-            
-            # Monitor transactions periodically
-            current_time = time.time()
-            if current_time - last_monitor >= POLL_INTERVAL_SEC:
-                bot.monitor_transactions()
-                last_monitor = current_time
-            
-            time.sleep(1)
-            
         except KeyboardInterrupt:
+            bot.save_snapshot()
             logger.info("Bot stopped by user")
             break
         except Exception as e:
@@ -840,4 +2293,4 @@ def run_bot():
             time.sleep(5)
 
 if __name__ == '__main__':
-    run_bot()
\ No newline at end of file
+    run_bot()